@@ -1,9 +1,14 @@
+import hashlib
 import os
-from datetime import datetime, date, timedelta
+from functools import wraps
+from datetime import datetime, date, timedelta, timezone
 
-from flask import Flask, render_template, request, redirect, url_for, session
+from flask import Flask, render_template, request, redirect, url_for, session, abort, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import text
+from sqlalchemy import case, event, func, insert, inspect, text
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.schema import CreateIndex
 
 # -------------------------------------------------
 # KONFIGURACIJA
@@ -19,50 +24,94 @@ APP_PASSWORD = os.getenv("APP_PASSWORD", "pikapolonica")
 
 # DATABASE_URL bo nastavljen v oblaku (PostgreSQL).
 # Lokalno, če ni nastavljena, uporabimo SQLite datoteko.
-db_url = os.getenv("DATABASE_URL", "sqlite:///tasks.db")
+db_url = make_url(os.getenv("DATABASE_URL", "sqlite:///tasks.db"))
 
-# Nekateri providerji uporabljajo "postgres://", SQLAlchemy hoče "postgresql://"
-if db_url.startswith("postgres://"):
-    db_url = db_url.replace("postgres://", "postgresql://", 1)
+# Nekateri providerji uporabljajo "postgres://"; za Postgres izberemo gonilnik psycopg (v3).
+if db_url.drivername in ("postgres", "postgresql"):
+    db_url = db_url.set(drivername="postgresql+psycopg")
 
-app.config["SQLALCHEMY_DATABASE_URI"] = db_url
+app.config["SQLALCHEMY_DATABASE_URI"] = db_url.render_as_string(hide_password=False)
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
+# Bazen povezav za strežniško bazo (Postgres), da kratki zahtevki ne odpirajo novih povezav.
+if db_url.get_backend_name() != "sqlite":
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "pool_size": 10,
+        "max_overflow": 20,
+        "pool_pre_ping": True,
+        "pool_recycle": 1800,
+    }
+
 db = SQLAlchemy(app)
 
 
+def compute_page_version() -> str:
+    """Kratek hash kode in predlog; ob novi verziji se spremeni ETag strani."""
+    template_dir = os.path.join(app.root_path, app.template_folder)
+    paths = [__file__] + sorted(
+        os.path.join(template_dir, name) for name in os.listdir(template_dir)
+    )
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+
+PAGE_VERSION = compute_page_version()
+
+
 # Predefinirani tipi nalog
-TASK_TYPES = [
+TASK_TYPES = (
     "Kviz iz vaj",
     "Kviz iz teorije",
     "Vaja",
     "Kolokvij",
     "Izpit",
     "Test iz vaj",
-]
+)
 
-PRIORITY_LEVELS = ["obvezno", "neobvezno"]
+PRIORITY_LEVELS = ("obvezno", "neobvezno")
 
 
 # -------------------------------------------------
 # MODEL: naloga
 # -------------------------------------------------
+def utcnow() -> datetime:
+    """Trenutni čas v UTC (brez tzinfo); ne skače nazaj ob koncu poletnega časa."""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
 class Task(db.Model):
+    # pregled in glavni seznam filtrirata nedokončane naloge in sortirata po roku
+    __table_args__ = (
+        # delni indeks samo za nedokončane naloge; pogoj se mora ujemati s
+        # tem, kar izriše Task.is_done.is_(False), sicer ga planer ne uporabi
+        db.Index(
+            "ix_task_pending",
+            "due_date",
+            postgresql_where=db.text("is_done IS false"),
+            sqlite_where=db.text("is_done IS 0"),
+        ),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200), nullable=False)        # naslov naloge
     task_type = db.Column(db.String(50), nullable=False)     # npr. "naloga", "kolokvij", "kviz"
-    subject = db.Column(db.String(100), nullable=False)      # predmet (Matematika, Fizika ...)
+    subject = db.Column(db.String(100), nullable=False, index=True)  # predmet (Matematika, Fizika ...)
     due_date = db.Column(db.Date, nullable=False)            # rok (datum)
     description = db.Column(db.Text)                         # opis, link na ucilnice
     is_done = db.Column(db.Boolean, default=False)           # ali je opravljena
     priority = db.Column(db.String(20), nullable=False, default="obvezno")  # obvezno / neobvezno
+    updated_at = db.Column(db.DateTime, default=utcnow, onupdate=utcnow, index=True)  # za ETag
 
-    def is_overdue(self):
-        return (not self.is_done) and self.due_date < datetime.today().date()
+    def is_overdue(self, today=None):
+        today = today or date.today()
+        return (not self.is_done) and self.due_date < today
 
-    def is_soon(self):
+    def is_soon(self, today=None):
         # "kmalu" = danes ali jutri
-        today = datetime.today().date()
+        today = today or date.today()
         delta = (self.due_date - today).days
         return (not self.is_done) and (0 <= delta <= 1)
 
@@ -70,20 +119,47 @@ class Task(db.Model):
 # -------------------------------------------------
 # INITIALIZACIJA BAZE
 # -------------------------------------------------
+def set_sqlite_pragmas(dbapi_conn, _connection_record):
+    # WAL: branja ne blokirajo pisanja, commit naredi manj fsync-ov
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA mmap_size=134217728")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.close()
+
+
 with app.app_context():
+    if db.engine.dialect.name == "sqlite":
+        event.listen(db.engine, "connect", set_sqlite_pragmas)
+
     db.create_all()
 
-    # Poskrbimo, da stolpec priority obstaja (za SQLite in Postgres).
-    try:
-        with db.engine.connect() as conn:
-            conn.execute(
-                text(
-                    "ALTER TABLE task ADD COLUMN priority VARCHAR(20) NOT NULL DEFAULT 'obvezno'"
-                )
-            )
-    except Exception:
-        # Če stolpec že obstaja ali ALTER ni potreben, napako ignoriramo.
-        pass
+    # Poskrbimo, da stolpca priority in updated_at obstajata (za SQLite in Postgres).
+    # ALTER poženemo samo, če stolpca res ni, da ob vsakem zagonu ne zaklepamo sheme.
+    # Več gunicorn workerjev se zažene hkrati, zato mora DDL prenesti, da ga je
+    # medtem že izvedel drug worker.
+    if_not_exists = "IF NOT EXISTS " if db.engine.dialect.name == "postgresql" else ""
+    task_columns = {c["name"] for c in inspect(db.engine).get_columns("task")}
+    missing_columns = {
+        "priority": "priority VARCHAR(20) NOT NULL DEFAULT 'obvezno'",
+        "updated_at": "updated_at TIMESTAMP",
+    }
+    for column, definition in missing_columns.items():
+        if column in task_columns:
+            continue
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(text(f"ALTER TABLE task ADD COLUMN {if_not_exists}{definition}"))
+        except DBAPIError:
+            # SQLite nima ADD COLUMN IF NOT EXISTS; napaka je v redu, če stolpec zdaj obstaja
+            if column not in {c["name"] for c in inspect(db.engine).get_columns("task")}:
+                raise
+
+    # create_all ne doda indeksov v že obstoječo tabelo, zato jih ustvarimo posebej.
+    with db.engine.begin() as conn:
+        for index in Task.__table__.indexes:
+            conn.execute(CreateIndex(index, if_not_exists=True))
 
 
 # -------------------------------------------------
@@ -94,21 +170,33 @@ def is_logged_in() -> bool:
     return session.get("logged_in", False)
 
 
-def require_login(endpoint_name: str) -> bool:
-    """Ali je treba biti prijavljen za dostop do endpointa."""
-    public_endpoints = {"login", "static"}
-    return endpoint_name not in public_endpoints
+def login_required(view):
+    """Dekorator za poglede, ki zahtevajo prijavo."""
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        if not is_logged_in():
+            return redirect(url_for("login"))
+        return view(*args, **kwargs)
 
+    return wrapped
 
-@app.before_request
-def check_login():
-    # Če endpoint ni znan (npr. 404), preskočimo
-    endpoint = request.endpoint
-    if not endpoint:
-        return
 
-    if require_login(endpoint) and not is_logged_in():
-        return redirect(url_for("login"))
+# -------------------------------------------------
+# POMOŽNE FUNKCIJE ZA FORMO
+# -------------------------------------------------
+
+def read_task_form() -> dict:
+    """Prebere polja naloge iz POST forme (skupno za dodajanje in urejanje)."""
+    form = request.form
+    return {
+        "title": form["title"].strip(),
+        "task_type": form["task_type"].strip(),
+        "subject": form["subject"].strip(),
+        # HTML <input type="date"> vrne "YYYY-MM-DD"
+        "due_date": date.fromisoformat(form["due_date"]),
+        "description": form.get("description", "").strip(),
+        "priority": form.get("priority", "obvezno").strip() or "obvezno",
+    }
 
 
 # -------------------------------------------------
@@ -116,12 +204,28 @@ def check_login():
 # -------------------------------------------------
 
 @app.route("/")
+@login_required
 def index():
     show_done = request.args.get("show_done", "0") == "1"
     subject_filter = request.args.get("subject", "")
     range_filter = request.args.get("range", "")  # "", "overdue", "today", "week", "two_weeks", "later"
 
-    # seznam vseh predmetov za filter (distinct)
+    # današnji datum izračunamo enkrat in ga podamo predlogi
+    today = date.today()
+
+    # ETag: če se od zadnjega obiska ni nič spremenilo, strani ne izrisujemo znova
+    latest, task_count = db.session.query(
+        func.max(Task.updated_at), func.count(Task.id)
+    ).one()
+    etag = f"{PAGE_VERSION}-{today.isoformat()}-{task_count}-{latest.isoformat() if latest else 0}"
+    # šibka primerjava, ker proxy (npr. gzip v nginx) ETag lahko spremeni v W/"..."
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+
+    # seznam vseh predmetov za filter (distinct, bere se iz indeksa ix_task_subject);
+    # ponovni obiski se ustavijo že pri ETag
     subjects = [
         s[0]
         for s in db.session.query(Task.subject)
@@ -134,32 +238,29 @@ def index():
     if subject_filter:
         base_query = base_query.filter(Task.subject == subject_filter)
 
-    today = date.today()
-
-    # pregled obveznosti (samo nedokončane naloge)
-    overview_query = base_query.filter(Task.is_done.is_(False))
-    overview_tasks = overview_query.all()
+    # pregled obveznosti (samo nedokončane naloge): predloga rabi le število
+    # nalog v vsaki skupini, zato jih razvrsti in prešteje kar baza
+    bucket = case(
+        (Task.due_date < today, "overdue"),
+        (Task.due_date == today, "today"),
+        (Task.due_date <= today + timedelta(days=7), "week"),
+        (Task.due_date <= today + timedelta(days=14), "two_weeks"),
+        else_="later",
+    ).label("bucket")
+    overview_query = db.session.query(bucket, func.count(Task.id)).filter(
+        Task.is_done.is_(False)
+    )
+    if subject_filter:
+        overview_query = overview_query.filter(Task.subject == subject_filter)
 
     overview = {
-        "overdue": [],
-        "today": [],
-        "week": [],
-        "two_weeks": [],
-        "later": [],
+        "overdue": 0,
+        "today": 0,
+        "week": 0,
+        "two_weeks": 0,
+        "later": 0,
     }
-
-    for t in overview_tasks:
-        delta = (t.due_date - today).days
-        if delta < 0:
-            overview["overdue"].append(t)
-        elif delta == 0:
-            overview["today"].append(t)
-        elif delta <= 7:
-            overview["week"].append(t)
-        elif delta <= 14:
-            overview["two_weeks"].append(t)
-        else:
-            overview["later"].append(t)
+    overview.update(overview_query.group_by(bucket).all())
 
     # glavni seznam nalog
     query = base_query
@@ -189,41 +290,35 @@ def index():
         if not show_done:
             query = query.filter(Task.is_done.is_(False))
 
-    tasks = query.order_by(Task.due_date.asc()).all()
-
-    return render_template(
-        "index.html",
-        tasks=tasks,
-        show_done=show_done,
-        subjects=subjects,
-        subject_filter=subject_filter,
-        overview=overview,
-        range_filter=range_filter,
-    )
+    # vrstice beremo v paketih, HTML pa pretakamo sproti med izrisovanjem
+    tasks = query.order_by(Task.due_date.asc()).yield_per(200)
+
+    context = {
+        "tasks": tasks,
+        "show_done": show_done,
+        "subjects": subjects,
+        "subject_filter": subject_filter,
+        "overview": overview,
+        "range_filter": range_filter,
+        "today": today,
+    }
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template("index.html").stream(context)
+    # brez medpomnilnika Jinja vrne vsak košček posebej (~40 B); združimo jih v ~8 KB kose
+    stream.enable_buffering(200)
+    response = app.response_class(stream_with_context(stream))
+    response.set_etag(etag)
+    # brskalnik naj stran vedno preveri (If-None-Match), preden jo prikaže iz predpomnilnika
+    response.cache_control.no_cache = True
+    return response
 
 
 @app.route("/add", methods=["GET", "POST"])
+@login_required
 def add_task():
     if request.method == "POST":
-        title = request.form["title"].strip()
-        task_type = request.form["task_type"].strip()
-        subject = request.form["subject"].strip()
-        due_date_str = request.form["due_date"]
-        description = request.form.get("description", "").strip()
-        priority = request.form.get("priority", "obvezno").strip() or "obvezno"
-
-        # HTML <input type="date"> vrne "YYYY-MM-DD"
-        due_date = datetime.strptime(due_date_str, "%Y-%m-%d").date()
-
-        task = Task(
-            title=title,
-            task_type=task_type,
-            subject=subject,
-            due_date=due_date,
-            description=description,
-            priority=priority,
-        )
-        db.session.add(task)
+        # objekta ne potrebujemo več, zato vstavimo neposredno brez ORM identity map
+        db.session.execute(insert(Task).values(**read_task_form()))
         db.session.commit()
         return redirect(url_for("index"))
 
@@ -231,18 +326,13 @@ def add_task():
 
 
 @app.route("/edit/<int:task_id>", methods=["GET", "POST"])
+@login_required
 def edit_task(task_id):
     task = Task.query.get_or_404(task_id)
 
     if request.method == "POST":
-        task.title = request.form["title"].strip()
-        task.task_type = request.form["task_type"].strip()
-        task.subject = request.form["subject"].strip()
-        due_date_str = request.form["due_date"]
-        task.description = request.form.get("description", "").strip()
-        task.priority = request.form.get("priority", "obvezno").strip() or "obvezno"
-
-        task.due_date = datetime.strptime(due_date_str, "%Y-%m-%d").date()
+        for field, value in read_task_form().items():
+            setattr(task, field, value)
 
         db.session.commit()
         return redirect(url_for("index"))
@@ -252,6 +342,7 @@ def edit_task(task_id):
 
 
 @app.route("/delete/<int:task_id>", methods=["POST"])
+@login_required
 def delete_task(task_id):
     task = Task.query.get_or_404(task_id)
     db.session.delete(task)
@@ -260,18 +351,37 @@ def delete_task(task_id):
 
 
 @app.route("/done/<int:task_id>")
+@login_required
 def mark_done(task_id):
-    task = Task.query.get_or_404(task_id)
-    task.is_done = True
+    # en sam UPDATE brez predhodnega SELECT-a
+    updated = Task.query.filter_by(id=task_id).update({"is_done": True})
     db.session.commit()
+    if not updated:
+        abort(404)
     return redirect(url_for("index"))
 
 
 @app.route("/undo/<int:task_id>")
+@login_required
 def mark_undone(task_id):
-    task = Task.query.get_or_404(task_id)
-    task.is_done = False
+    # en sam UPDATE brez predhodnega SELECT-a
+    updated = Task.query.filter_by(id=task_id).update({"is_done": False})
     db.session.commit()
+    if not updated:
+        abort(404)
+    return redirect(url_for("index"))
+
+
+@app.route("/done_bulk", methods=["POST"])
+@login_required
+def mark_done_bulk():
+    # vse izbrane naloge označimo z enim UPDATE in enim commitom
+    task_ids = request.form.getlist("ids", type=int)
+    if task_ids:
+        Task.query.filter(Task.id.in_(task_ids)).update(
+            {"is_done": True}, synchronize_session=False
+        )
+        db.session.commit()
     return redirect(url_for("index"))
 
 
@@ -281,8 +391,9 @@ def mark_undone(task_id):
 def login():
     error = None
     if request.method == "POST":
-        username = request.form["username"].strip()
-        password = request.form["password"].strip()
+        form = request.form
+        username = form["username"].strip()
+        password = form["password"].strip()
 
         if username == APP_USERNAME and password == APP_PASSWORD:
             session["logged_in"] = True
@@ -295,12 +406,12 @@ def login():
 
 
 @app.route("/logout")
+@login_required
 def logout():
     session.clear()
     return redirect(url_for("login"))
 
 
 if __name__ == "__main__":
-    # Lokalni development server
-    app.run(debug=True)
+    # Lokalni development server (v produkciji teče gunicorn, glej Procfile)
     app.run(debug=True)